@@ -6,7 +6,7 @@ import time
 import argparse
 
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, DeferredList
 from autobahn.twisted.util import sleep as dsleep
 
 import os
@@ -83,6 +83,28 @@ class HostManager:
         returnValue((instances, warnings))
         yield
 
+    @inlineCallbacks
+    def _parse_docker_composes(self):
+        """Run hm_utils.parse_docker_state on all the docker-compose
+        files, concurrently.
+
+        Returns:
+          A list with the parsed services dict for each entry in
+          self.docker_composes, in the same order.
+
+        """
+        results = yield DeferredList(
+            [hm_utils.parse_docker_state(
+                compose, docker_compose_bin=self.docker_compose_bin)
+             for compose in self.docker_composes],
+            consumeErrors=True)
+        all_services = []
+        for ok, result in results:
+            if not ok:
+                result.raiseException()
+            all_services.append(result)
+        return all_services
+
     @inlineCallbacks
     def _update_docker_services(self):
         """Parse the docker-compose.yaml files and update the internal cache
@@ -96,9 +118,8 @@ class HostManager:
         """
         # Read services from all docker-compose files.
         docker_services = {}
-        for compose in self.docker_composes:
-            services = yield hm_utils.parse_docker_state(
-                compose, docker_compose_bin=self.docker_compose_bin)
+        all_services = yield self._parse_docker_composes()
+        for services in all_services:
             docker_services.update(services)
 
         # Mark containers that have disappeared.
@@ -141,7 +162,7 @@ class HostManager:
             if instance is None:
                 return
             instance['management'] = 'retired'
-            instance['at'] = time.time()
+            instance['at'] = time.monotonic()
             instance['target_state'] = 'down'
 
         # First identify items that we were managing that have
@@ -264,9 +285,8 @@ class HostManager:
         docker_managed = {info['agent_script']: info
                           for info in self.database.values()
                           if info['management'] == 'docker'}
-        for compose in self.docker_composes:
-            services = yield hm_utils.parse_docker_state(
-                compose, docker_compose_bin=self.docker_compose_bin)
+        all_services = yield self._parse_docker_composes()
+        for services in all_services:
             for k, info in services.items():
                 db = docker_managed.get(k)
                 if db is not None:
@@ -457,14 +477,14 @@ class HostManager:
             'child_states': [],
         }
 
-        next_docker_update = time.time()
+        next_docker_update = time.monotonic()
 
         any_jobs = False
         while self.running or any_jobs:
 
-            if time.time() >= next_docker_update:
+            if time.monotonic() >= next_docker_update:
                 yield self._check_docker_states()
-                next_docker_update = time.time() + 2
+                next_docker_update = time.monotonic() + 2
 
             sleep_times = [1.]
             any_jobs = False
@@ -1,11 +1,19 @@
+import bisect
+import json
 import os
 import shutil
 import time
 import yaml
+from collections import deque
 
-from twisted.internet import reactor, utils, protocol
+from twisted.internet import utils, protocol
 from twisted.internet.defer import inlineCallbacks
 
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
 
 class ManagedInstance(dict):
     """Track properties of a managed Agent-instance.  This is just a dict
@@ -34,11 +42,12 @@ class ManagedInstance(dict):
       this will sometimes indicate the "current state" (up or down),
       but sometimes it will carry a transitional state, such as
       "wait_start".
-    - 'at' (float): a unix timestamp for transitional states
-      (e.g. used to set how long to wait for something).
-    - 'fail_times' (list of floats): unix timestamps when the instance
-      process has stopped unexpectedly (used to identify "unstable"
-      agents).
+    - 'at' (float): a time.monotonic() timestamp for transitional
+      states (e.g. used to set how long to wait for something).
+    - 'fail_times' (deque of floats): time.monotonic() timestamps
+      when the instance process has stopped unexpectedly (used to
+      identify "unstable" agents).  Only the most recent 200 are
+      kept.
 
     """
     @classmethod
@@ -49,13 +58,153 @@ class ManagedInstance(dict):
             'prot': None,
             'next_action': 'down',
             'target_state': 'down',
-            'fail_times': [],
+            'fail_times': deque(maxlen=200),
             'at': 0,
         })
         self.update(kwargs)
         return self
 
 
+# State machine handlers for resolve_child_state.  Each one is called
+# as handler(db, now, actions), may update db and actions in place
+# (including appending to actions['messages'] and setting
+# actions['sleep']), and returns nothing.
+
+# The uninterruptible transition state(s) are most easily handled
+# in the same way regardless of target state.
+
+def _wait_start(db, now, actions):
+    # Transitional: wait_start, which bridges from start -> up.
+    if db['prot'] is not None:
+        actions['messages'].append(f'Launched {db["full_name"]}')
+        db['next_action'] = 'up'
+    elif now >= db['at']:
+        actions['messages'].append(f'Launch not detected for '
+                                   f'{db["full_name"]}!  Will retry.')
+        db['next_action'] = 'start_at'
+        db['at'] = now + 5.
+
+
+def _wait_dead(db, now, actions):
+    # Transitional: wait_dead, which bridges from kill -> idle.
+    prot = db['prot']
+    if prot is None:
+        stat, t = 0, None
+    else:
+        stat, t = prot.status
+    at = db['at']
+    if stat is not None:
+        db['next_action'] = 'down'
+    elif now >= at:
+        actions['messages'].append(f'Agent instance {db["full_name"]} '
+                                   f'refused to die.')
+        db['next_action'] = 'down'
+    else:
+        actions['sleep'] = at - now
+
+
+# State handling when target is to be 'up'.
+
+def _up_start_at(db, now, actions):
+    at = db['at']
+    if now >= at:
+        db['next_action'] = 'start'
+    else:
+        actions['sleep'] = at - now
+
+
+def _up_start(db, now, actions):
+    actions['messages'].append(
+        f'Requested launch for {db["full_name"]}')
+    db['prot'] = None
+    actions['launch'] = True
+    db['next_action'] = 'wait_start'
+    db['at'] = now + 1.
+
+
+def _up_up(db, now, actions):
+    prot = db['prot']
+    stat, t = prot.status
+    if stat is None:
+        return
+    messages = actions['messages']
+    messages.append(f'Detected exit of {db["full_name"]} '
+                    f'with code {stat}.')
+    if hasattr(prot, 'output'):
+        note = ''
+        lines = prot.output['stderr'].getvalue().decode(
+            'utf8', 'replace').splitlines()
+        if len(lines) > 50:
+            note = ' (trimmed)'
+            lines = lines[-20:]
+        text = '\n'.join(lines)
+        messages.append(f'stderr output from {db["full_name"]}'
+                        f'{note}: {text}')
+    db['next_action'] = 'start_at'
+    db['at'] = now + 3
+    db['fail_times'].append(now)
+
+
+def _up_down(db, now, actions):
+    db['next_action'] = 'start'
+
+
+# State handling when target is to be 'down'.
+
+def _down_down(db, now, actions):
+    # The lines below will prevent HostManager from killing
+    # Agents that suddenly seem to be alive.  With these
+    # lines commented out, someone running "up" on a managed
+    # docker-compose.yaml will see their Agents immediately
+    # be brought down by HostManager.
+    # if prot is not None and prot.status[0] is None:
+    #    messages.append('Detected unexpected session for {full_name} '
+    #                    '(probably docker); changing target state to "up".'.format(**db))
+    #    db['target_state'] = 'up'
+
+    # In fully managed mode, force a termination.
+    prot = db['prot']
+    if prot is not None and prot.status[0] is None:
+        actions['messages'].append(
+            f'Detected unexpected session for {db["full_name"]} '
+            f'(probably docker); it will be shut down.')
+        db['next_action'] = 'up'
+
+
+def _down_up(db, now, actions):
+    actions['messages'].append(f'Requesting termination of '
+                               f'{db["full_name"]}')
+    actions['terminate'] = True
+    db['next_action'] = 'wait_dead'
+    db['at'] = now + 5
+
+
+def _down_pending(db, now, actions):
+    # From 'start_at' or 'start'.
+    actions['messages'].append(f'Modifying state of {db["full_name"]} from '
+                               f'{db["next_action"]} to idle')
+    db['next_action'] = 'down'
+
+
+# Handlers keyed by (target_state, next_action).  The transitional
+# states are handled the same way for either target, so every state
+# is resolved with a single lookup.
+_HANDLERS = {
+    ('up', 'wait_start'): _wait_start,
+    ('up', 'wait_dead'): _wait_dead,
+    ('down', 'wait_start'): _wait_start,
+    ('down', 'wait_dead'): _wait_dead,
+    ('up', 'start_at'): _up_start_at,
+    ('up', 'start'): _up_start,
+    ('up', 'up'): _up_up,
+    ('up', 'down'): _up_down,
+    ('down', 'down'): _down_down,
+    ('down', 'up'): _down_up,
+    ('down', 'start_at'): _down_pending,
+    ('down', 'start'): _down_pending,
+}
+
+
 def resolve_child_state(db):
     """Args:
 
@@ -74,145 +223,87 @@ def resolve_child_state(db):
 
     """
     actions = {
+        'messages': [],
         'launch': False,
         'terminate': False,
         'sleep': None,
     }
 
-    messages = []
-    sleeps = []
-
-    # State machine.
-    prot = db['prot']
-
-    # The uninterruptible transition state(s) are most easily handled
-    # in the same way regardless of target state.
-
-    # Transitional: wait_start, which bridges from start -> up.
-    if db['next_action'] == 'wait_start':
-        if prot is not None:
-            messages.append('Launched {full_name}'.format(**db))
-            db['next_action'] = 'up'
-        else:
-            if time.time() >= db['at']:
-                messages.append('Launch not detected for '
-                                '{full_name}!  Will retry.'.format(**db))
-                db['next_action'] = 'start_at'
-                db['at'] = time.time() + 5.
-
-    # Transitional: wait_dead, which bridges from kill -> idle.
-    elif db['next_action'] == 'wait_dead':
-        if prot is None:
-            stat, t = 0, None
-        else:
-            stat, t = prot.status
-        if stat is not None:
-            db['next_action'] = 'down'
-        elif time.time() >= db['at']:
-            if stat is None:
-                messages.append('Agent instance {full_name} '
-                                'refused to die.'.format(**db))
-                db['next_action'] = 'down'
-        else:
-            sleeps.append(db['at'] - time.time())
-
-    # State handling when target is to be 'up'.
-    elif db['target_state'] == 'up':
-        if db['next_action'] == 'start_at':
-            if time.time() >= db['at']:
-                db['next_action'] = 'start'
-            else:
-                sleeps.append(db['at'] - time.time())
-        elif db['next_action'] == 'start':
-            messages.append(
-                'Requested launch for {full_name}'.format(**db))
-            db['prot'] = None
-            actions['launch'] = True
-            db['next_action'] = 'wait_start'
-            now = time.time()
-            db['at'] = now + 1.
-        elif db['next_action'] == 'up':
-            stat, t = prot.status
-            if stat is not None:
-                messages.append('Detected exit of {full_name} '
-                                'with code {stat}.'.format(stat=stat, **db))
-                if hasattr(prot, 'lines'):
-                    note = ''
-                    lines = prot.lines['stderr']
-                    if len(lines) > 50:
-                        note = ' (trimmed)'
-                        lines = lines[-20:]
-                    messages.append('stderr output from {full_name}{note}: {}'
-                                    .format('\n'.join(lines), note=note, **db))
-                db['next_action'] = 'start_at'
-                db['at'] = time.time() + 3
-                db['fail_times'].append(time.time())
-        else:  # 'down'
-            db['next_action'] = 'start'
-
-    # State handling when target is to be 'down'.
-    elif db['target_state'] == 'down':
-        if db['next_action'] == 'down':
-            # The lines below will prevent HostManager from killing
-            # Agents that suddenly seem to be alive.  With these
-            # lines commented out, someone running "up" on a managed
-            # docker-compose.yaml will see their Agents immediately
-            # be brought down by HostManager.
-            # if prot is not None and prot.status[0] is None:
-            #    messages.append('Detected unexpected session for {full_name} '
-            #                    '(probably docker); changing target state to "up".'.format(**db))
-            #    db['target_state'] = 'up'
-
-            # In fully managed mode, force a termination.
-            if prot is not None and prot.status[0] is None:
-                messages.append('Detected unexpected session for {full_name} '
-                                '(probably docker); it will be shut down.'.format(**db))
-                db['next_action'] = 'up'
-        elif db['next_action'] == 'up':
-            messages.append('Requesting termination of '
-                            '{full_name}'.format(**db))
-            actions['terminate'] = True
-            db['next_action'] = 'wait_dead'
-            db['at'] = time.time() + 5
-        else:  # 'start_at', 'start'
-            messages.append('Modifying state of {full_name} from '
-                            '{next_action} to idle'.format(**db))
-            db['next_action'] = 'down'
-
-    # Should not get here.
+    next_action = db['next_action']
+    target_state = db['target_state']
+    handler = _HANDLERS.get((target_state, next_action))
+    if handler is None:
+        # Should not get here.
+        actions['messages'].append(
+            f'State machine failure: state={next_action}, target_state'
+            f'={target_state}')
     else:
-        messages.append(
-            'State machine failure: state={next_action}, target_state'
-            '={target_state}'.format(**db))
-
-    actions['messages'] = messages
-    if len(sleeps):
-        actions['sleep'] = min(sleeps)
+        handler(db, time.monotonic(), actions)
     return actions
 
 
 def stability_factor(times, window=120):
-    """Given an increasing list of failure times, quantify the stability
-    of the activity.
+    """Given an increasing deque of failure times, quantify the
+    stability of the activity.
 
     A single failure, 10 seconds in the past, has a stability factor
     of 0.5; if there were additional failures before that, the
     stability factor will be lower.
 
-    Returns a culled list of stop times and a stability factor (0 -
-    1).
+    Returns the stop times, culled in place, and a stability factor
+    (0 - 1).
 
     """
-    now = time.time()
+    now = time.monotonic()
     if len(times) == 0:
         return times, 1.
-    # Only keep the last few failures, within our time window.
-    times = [t for t in times[-200:-1]
-             if t >= now - window] + times[-1:]
+    # Only keep the failures within our time window (and always the
+    # most recent one).
+    cutoff = min(bisect.bisect_left(times, now - window), len(times) - 1)
+    for _ in range(cutoff):
+        times.popleft()
     dt = [5. / (now - t) for t in times]
     return times, max(1 - sum(dt), 0.)
 
 
+class OutputBuffer:
+    """Fixed-size ring buffer holding the most recent bytes written
+    to it.  Used to retain the tail of a child process' output without
+    allocating per chunk received.
+
+    """
+
+    def __init__(self, size=65536):
+        self._buf = bytearray(size)
+        self._head = 0
+        self._full = False
+
+    def write(self, data):
+        size = len(self._buf)
+        data = memoryview(data)
+        if len(data) >= size:
+            self._buf[:] = data[-size:]
+            self._head = 0
+            self._full = True
+            return
+        end = self._head + len(data)
+        if end <= size:
+            self._buf[self._head:end] = data
+        else:
+            split = size - self._head
+            self._buf[self._head:] = data[:split]
+            self._buf[:end - size] = data[split:]
+        if end >= size:
+            self._full = True
+        self._head = end % size
+
+    def getvalue(self):
+        """Return the buffered bytes, oldest first."""
+        if not self._full:
+            return bytes(self._buf[:self._head])
+        return bytes(self._buf[self._head:] + self._buf[:self._head])
+
+
 class AgentProcessHelper(protocol.ProcessProtocol):
     def __init__(self, instance_id, cmd):
         super().__init__()
@@ -220,13 +311,16 @@ class AgentProcessHelper(protocol.ProcessProtocol):
         self.killed = False
         self.instance_id = instance_id
         self.cmd = cmd
-        self.lines = {'stderr': [],
-                      'stdout': []}
+        # Recent raw output; decoded only when needed.
+        self.output = {'stderr': OutputBuffer(),
+                       'stdout': OutputBuffer()}
 
     def up(self):
+        from twisted.internet import reactor
         reactor.spawnProcess(self, self.cmd[0], self.cmd[:], env=os.environ)
 
     def down(self):
+        from twisted.internet import reactor
         self.killed = True
         # race condition, but it could be worse.
         if self.status[0] is None:
@@ -259,17 +353,13 @@ class AgentProcessHelper(protocol.ProcessProtocol):
 
     def processExited(self, status):
         # print('%s.status:' % self.instance_id, status)
-        self.status = status, time.time()
+        self.status = status, time.monotonic()
 
     def outReceived(self, data):
-        self.lines['stdout'].extend(data.decode('utf8').split('\n'))
-        if len(self.lines['stdout']) > 100:
-            self.lines['stdout'] = self.lines['stdout'][-100:]
+        self.output['stdout'].write(data)
 
     def errReceived(self, data):
-        self.lines['stderr'].extend(data.decode('utf8').split('\n'))
-        if len(self.lines['stderr']) > 100:
-            self.lines['stderr'] = self.lines['stderr'][-100:]
+        self.output['stderr'].write(data)
 
 
 def _run_docker_compose(args, docker_compose_bin=None):
@@ -292,7 +382,7 @@ class DockerContainerHelper:
 
     def __init__(self, service, docker_compose_bin=None):
         self.service = {}
-        self.status = -1, time.time()
+        self.status = -1, time.monotonic()
         self.killed = False
         self.instance_id = service['service']
         self.d = None
@@ -306,16 +396,16 @@ class DockerContainerHelper:
         """
         self.service.update(service)
         if service['running']:
-            self.status = None, time.time()
+            self.status = None, time.monotonic()
         else:
-            self.status = service['exit_code'], time.time()
+            self.status = service['exit_code'], time.monotonic()
 
     def up(self):
         self.d = _run_docker_compose(
             ['-f', self.service['compose_file'],
              'up', '-d', self.service['service']],
             docker_compose_bin=self.docker_compose_bin)
-        self.status = None, time.time()
+        self.status = None, time.monotonic()
 
     def down(self):
         self.d = _run_docker_compose(
@@ -351,7 +441,8 @@ def parse_docker_state(docker_compose_file, docker_compose_bin=None):
 
     summary = {}
 
-    compose = yaml.safe_load(open(docker_compose_file, 'r'))
+    with open(docker_compose_file, 'r') as f:
+        compose = yaml.load(f, Loader=_YamlLoader)
     for key, cfg in compose.get('services', []).items():
         summary[key] = {
             'service': key,
@@ -373,22 +464,29 @@ def parse_docker_state(docker_compose_file, docker_compose_bin=None):
     cont_ids = [line.strip() for line in out.decode('utf8').split('\n')
                 if line.strip() != '']
 
-    # Run docker inspect.
-    for cont_id in cont_ids:
-        out, err, code = yield utils.getProcessOutputAndValue(
-            'docker', ['inspect', cont_id], env=os.environ)
-        if code != 0 and 'No such object' in err.decode('utf8'):
-            # This is likely due to a race condition where some
-            # container was brought down since we ran docker-compose.
-            # Just drop the entry.
-            print(f'(no such object: {cont_id}')
-            continue
-        elif code != 0:
+    if len(cont_ids) == 0:
+        return summary
+
+    # Run docker inspect, on all containers at once.
+    out, err, code = yield utils.getProcessOutputAndValue(
+        'docker', ['inspect'] + cont_ids, env=os.environ)
+    if code != 0:
+        errors = [line.strip() for line in err.decode('utf8').split('\n')
+                  if line.strip() != '']
+        if len(errors) == 0 or \
+           not all('No such object' in line for line in errors):
             raise RuntimeError(
-                f'Trouble running "docker inspect %s".\n'
+                f'Trouble running "docker inspect {" ".join(cont_ids)}".\n'
                 f'stdout: {out}\n  stderr {err}')
+        # This is likely due to a race condition where some
+        # container was brought down since we ran docker-compose.
+        # The other containers are still reported; just drop the
+        # missing entries.
+        for line in errors:
+            print(f'({line})')
+
+    for info in json.loads(out or b'[]'):
         # Reconcile config against docker-compose ...
-        info = yaml.safe_load(out)[0]
         config = info['Config']['Labels']
         _dc_file = os.path.join(config['com.docker.compose.project.working_dir'],
                                 config['com.docker.compose.project.config_files'])
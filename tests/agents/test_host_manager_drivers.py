@@ -0,0 +1,121 @@
+import time
+from collections import deque
+
+import pytest
+
+from ocs.agents.host_manager.drivers import ManagedInstance, resolve_child_state, \
+    AgentProcessHelper, OutputBuffer, stability_factor
+
+
+class FakeProt:
+    def __init__(self, status=None):
+        self.status = status, None
+
+
+def _instance(**kwargs):
+    return ManagedInstance.init(management='host',
+                                agent_class='FakeDataAgent',
+                                instance_id='faker',
+                                full_name='FakeDataAgent:faker',
+                                **kwargs)
+
+
+def test_resolve_child_state_launch():
+    db = _instance(target_state='up', next_action='start')
+    actions = resolve_child_state(db)
+    assert actions['launch'] is True
+    assert db['next_action'] == 'wait_start'
+    assert actions['messages'] == ['Requested launch for FakeDataAgent:faker']
+
+    db['prot'] = FakeProt()
+    actions = resolve_child_state(db)
+    assert db['next_action'] == 'up'
+    assert actions['messages'] == ['Launched FakeDataAgent:faker']
+
+
+def test_resolve_child_state_exit_detected():
+    db = _instance(target_state='up', next_action='up', prot=FakeProt(1))
+    actions = resolve_child_state(db)
+    assert db['next_action'] == 'start_at'
+    assert len(db['fail_times']) == 1
+    assert actions['messages'] == [
+        'Detected exit of FakeDataAgent:faker with code 1.']
+
+    # Restart is delayed.
+    actions = resolve_child_state(db)
+    assert db['next_action'] == 'start_at'
+    assert 0 < actions['sleep'] <= 3
+
+
+def test_resolve_child_state_terminate():
+    db = _instance(target_state='down', next_action='up', prot=FakeProt())
+    actions = resolve_child_state(db)
+    assert actions['terminate'] is True
+    assert db['next_action'] == 'wait_dead'
+
+    db['prot'] = FakeProt(0)
+    actions = resolve_child_state(db)
+    assert db['next_action'] == 'down'
+    assert actions['messages'] == []
+
+
+def test_resolve_child_state_idle():
+    db = _instance(target_state='down', next_action='start_at')
+    actions = resolve_child_state(db)
+    assert db['next_action'] == 'down'
+    assert actions['messages'] == [
+        'Modifying state of FakeDataAgent:faker from start_at to idle']
+
+
+def test_resolve_child_state_invalid():
+    db = _instance(target_state='sideways', next_action='down')
+    actions = resolve_child_state(db)
+    assert db['next_action'] == 'down'
+    assert actions['messages'] == [
+        'State machine failure: state=down, target_state=sideways']
+
+
+def test_resolve_child_state_stderr():
+    prot = AgentProcessHelper('faker', ['true'])
+    for i in range(150):
+        prot.errReceived(f'line {i}\n'.encode('utf8'))
+    prot.status = 1, None
+
+    db = _instance(target_state='up', next_action='up', prot=prot)
+    actions = resolve_child_state(db)
+    assert actions['messages'][1].startswith(
+        'stderr output from FakeDataAgent:faker (trimmed): ')
+    text = actions['messages'][1].split(': ', 1)[1]
+    assert text.split('\n') == [f'line {i}' for i in range(130, 150)]
+
+
+def test_stability_factor():
+    times, stability = stability_factor(deque(maxlen=200))
+    assert stability == 1.
+
+    now = time.monotonic()
+    times = deque([now - 500, now - 400, now - 10], maxlen=200)
+    culled, stability = stability_factor(times)
+    assert culled is times
+    assert list(times) == [now - 10]
+    assert stability == pytest.approx(0.5, abs=.01)
+
+    # The most recent failure is always kept.
+    times = deque([now - 500, now - 400], maxlen=200)
+    culled, stability = stability_factor(times)
+    assert list(culled) == [now - 400]
+
+
+def test_output_buffer():
+    buf = OutputBuffer(size=8)
+    assert buf.getvalue() == b''
+    buf.write(b'abc')
+    assert buf.getvalue() == b'abc'
+    buf.write(b'defgh')
+    assert buf.getvalue() == b'abcdefgh'
+    buf.write(b'ijk')
+    assert buf.getvalue() == b'defghijk'
+    buf.write(b'0123456789')
+    assert buf.getvalue() == b'23456789'
+    buf.write(b'x')
+    assert buf.getvalue() == b'3456789x'